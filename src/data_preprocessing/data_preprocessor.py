@@ -1,5 +1,4 @@
 import numpy as np
-from scipy.interpolate import splprep, splev
 from agent.utils.dynamical_system_operations import normalize_state
 from data_preprocessing.data_loader import load_demonstrations
 
@@ -31,6 +30,10 @@ class DataPreprocessor:
         # Load demonstrations and associated data
         loaded_data = load_demonstrations(self.dataset_name, self.selected_primitives_id)
 
+        # Convert demonstrations to arrays only once, so they are not copied every time they are used
+        loaded_data['demonstrations raw'] = [np.ascontiguousarray(demo, dtype=np.float64)
+                                             for demo in loaded_data['demonstrations raw']]
+
         # Get features from demonstrations demonstrations
         features_demos = self.get_features_demos(loaded_data)
 
@@ -62,7 +65,7 @@ class DataPreprocessor:
         goals = self.get_goals(demonstrations_raw, primitive_ids)
 
         # Normalize goals
-        goals_training = normalize_state(goals, x_min, x_max)
+        goals_training = normalize_state(goals, x_min, x_max).astype(np.float32)
 
         # Get number of demonstrated trajectories
         n_trajectories = len(demonstrations_raw)
@@ -89,17 +92,13 @@ class DataPreprocessor:
         """
         if self.workspace_boundaries_type == 'from data':
             # Compute boundaries based on data
-            max_single_trajectory = []
-            min_single_trajectory = []
-
-            # Get max for every trajectory in each dimension
-            for j in range(len(demonstrations_raw)):
-                max_single_trajectory.append(np.array(demonstrations_raw[j]).max(axis=1))
-                min_single_trajectory.append(np.array(demonstrations_raw[j]).min(axis=1))
+            x_max = np.full(self.dim_workspace, -np.inf)
+            x_min = np.full(self.dim_workspace, np.inf)
 
-            # Get the max and min values along all of the trajectories
-            x_max = np.array(max_single_trajectory).max(axis=0)
-            x_min = np.array(min_single_trajectory).min(axis=0)
+            # Update the max and min values with every trajectory in each dimension
+            for demo in demonstrations_raw:
+                np.maximum(x_max, demo.max(axis=1), out=x_max)
+                np.minimum(x_min, demo.min(axis=1), out=x_min)
 
             # Add a tolerance
             x_max = x_max + (x_max - x_min) * self.state_increment / 2
@@ -118,25 +117,19 @@ class DataPreprocessor:
         """
         Computes length trajectories, longest trajectory and evaluation indexes for fast evaluation
         """
-        trajectories_length, eval_indexes = [], []
-        max_trajectory_length = 0
+        # Get trajectories length and find largest trajectory in demonstrations
+        trajectories_length = np.array([len(demonstrations_raw[j][0]) for j in range(n_trajectories)])
+        max_trajectory_length = int(trajectories_length.max())
 
-        # Iterate through each demonstration
-        for j in range(n_trajectories):
-            # Get trajectory length
-            length_demo = len(demonstrations_raw[j][0])
-            trajectories_length.append(length_demo)
-
-            # Find largest trajectory in demonstrations
-            if length_demo > max_trajectory_length:
-                max_trajectory_length = length_demo
-
-            # Obtain indexes used for fast evaluation
+        # Obtain indexes used for fast evaluation, once for every different trajectory length
+        eval_indexes_length = {}
+        for length_demo in np.unique(trajectories_length):
             if length_demo > self.eval_length:
                 eval_interval = np.floor(length_demo / self.eval_length)
-                eval_indexes.append(np.arange(0, length_demo, eval_interval, dtype=np.int32))
+                eval_indexes_length[length_demo] = np.arange(0, length_demo, eval_interval, dtype=np.int32)
             else:
-                eval_indexes.append(np.arange(0, length_demo, 1, dtype=np.int32))
+                eval_indexes_length[length_demo] = np.arange(0, length_demo, 1, dtype=np.int32)
+        eval_indexes = [eval_indexes_length[length_demo] for length_demo in trajectories_length]
 
         return max_trajectory_length, trajectories_length, eval_indexes
 
@@ -144,126 +137,167 @@ class DataPreprocessor:
         """
         Computes goal demonstrations from data
         """
-        # Iterate through primitives
-        goals = []
-        for i in np.unique(primitive_ids):
-            ids_primitives = primitive_ids == i
-            demonstrations_primitive_ids = np.array(np.where(ids_primitives))[0]
-            # Iterate through trajectories of each primitive
-            goals_primitive = []
-            for j in demonstrations_primitive_ids:
-                goals_primitive.append(np.array(demonstrations_raw[j])[:, -1])
-
-            # Average goals and append
-            goal_mean = np.mean(np.array(goals_primitive), axis=0)
-            goals.append(goal_mean)
-
-        return np.array(goals)
+        # Get last point of every demonstration
+        last_points = np.stack([demo[:, -1] for demo in demonstrations_raw])
+        primitive_ids = np.asarray(primitive_ids)
+
+        # Group demonstrations of the same primitive together
+        order = np.argsort(primitive_ids, kind='stable')
+        _, primitives_start, primitives_count = np.unique(primitive_ids[order], return_index=True, return_counts=True)
+
+        # Average last points of the trajectories of each primitive
+        goals = np.add.reduceat(last_points[order], primitives_start, axis=0) / primitives_count[:, np.newaxis]
+
+        return goals
 
     def generate_training_data(self, loaded_data, features_demos):
         """
-        Normalizes demonstrations, resamples demonstrations using spline to keep a constant distance between points,
+        Normalizes demonstrations, resamples demonstrations using linear interpolation to keep a constant distance between points,
         and creates imitation window for backpropagation through time
         """
         demonstrations_raw = loaded_data['demonstrations raw']
         n_trajectories = len(demonstrations_raw)
-        resampled_positions, error_acc = [], []
+        demos_norm, curve_phases, delta_phases = [], [], []
+
+        # Workspace range used for normalization, computed once for all of the demos
+        x_min = features_demos['x min']
+        x_range = features_demos['x max'] - x_min
 
         # Iterate through each demonstration
         for j in range(n_trajectories):
             if self.verbose:
                 print('Data preprocessing, demonstration %i / %i' % (j + 1, n_trajectories))
 
-            # Get current trajectory
-            demo = np.array(demonstrations_raw[j]).T
-            length_demo = demo.shape[0]
-
-            # Normalize demos
-            demo_norm = normalize_state(demo, x_min=features_demos['x min'], x_max=features_demos['x max'])
-
-            # Create phase array that spatially parametrizes demo in one dimension
-            curve_phase = 0
-            curve_phases, delta_phases = [curve_phase], []
-
-            for i in range(length_demo - 1):  # iterate through every point in trajectory and assign a phase value
-                # Compute phase increment based on distance of consecutive points
-                delta_phase = np.linalg.norm(demo_norm[i + 1, :] - demo_norm[i, :])
-
-                if delta_phase == 0:
-                    # If points in trajectory have zero phase difference, splprep throws error -> add small margin
-                    delta_phase += 1e-15
+            # Normalize demo and parametrize it with phases
+            demo_norm, curve_phases_demo, delta_phases_demo = self.get_demo_phases(demonstrations_raw[j], x_min,
+                                                                                   x_range)
+            demos_norm.append(demo_norm)
+            curve_phases.append(curve_phases_demo)
+            delta_phases.append(delta_phases_demo)
 
-                # Increment phase
-                curve_phase += delta_phase
-
-                # Store phase and delta of current point in curve
-                curve_phases.append(curve_phase)
-                delta_phases.append(delta_phase)
-
-            delta_phases.append(0)  # zero delta for last point
-            curve_phases = np.array(curve_phases)
-            delta_phases = np.array(delta_phases)
-            max_phase = curve_phases[-1]
-
-            # Create input for spline: demonstrations and corresponding phases
-            spline_input = []
-            for i in range(self.dim_workspace):
-                spline_input.append(demo_norm[:, i])
-            spline_input.append(curve_phases)
-            spline_input.append(delta_phases)
-
-            # Fit spline
-            spline_parameters, u = splprep(spline_input, s=0, k=1, u=curve_phases)  # s = 0 -> no smoothing; k = 1 -> linear interpolation
-
-            # Create initial phases u with spatially equidistant points
-            u = np.linspace(0, max_phase, self.trajectories_resample_length)
+        # Resample demos and create imitation window
+        resampled_positions = self.resample_demos(demos_norm, curve_phases, delta_phases)
+        return resampled_positions
 
-            # Iterate using imitation window size to get position labels for backpropagation through time
-            window = []
-            for _ in range(self.imitation_window_size + (self.dynamical_system_order - 1)):
-                # Compute demo positions based on current phase value
-                spline_values = splev(u, spline_parameters)
-                position_window = spline_values[:self.dim_workspace]
+    def get_demo_phases(self, demo_raw, x_min, x_range):
+        """
+        Normalizes a demonstration and creates phase array that spatially parametrizes it in one dimension
+        """
+        # Get current trajectory
+        demo = demo_raw.T
 
-                # Append position to window trajectory
-                window.append(position_window)
+        # Normalize demo, same operations as normalize_state with x_range = x_max - x_min
+        demo_norm = (((demo - x_min) / x_range) - 0.5) * 2
 
-                # Find phase for next point in imitation window
-                delta_phase = spline_values[-1]
-                next_phase = u + delta_phase
-                u = np.clip(next_phase, a_min=0, a_max=max_phase)  # update phase
+        # Compute phase increments based on distance of consecutive points
+        delta_phases = np.linalg.norm(np.diff(demo_norm, axis=0), axis=1)
 
-                # Accumulate error for debugging
-                predicted_phase = splev(u, spline_parameters)[-2]
-                error_acc.append(np.mean(np.abs(predicted_phase - next_phase)))
+        # If points in trajectory have zero phase difference, phases are not increasing -> add small margin
+        delta_phases[delta_phases == 0] += 1e-15
 
-            resampled_positions.append(window)
+        # Accumulate increments to get the phase of every point in the curve
+        curve_phases = np.concatenate(([0.0], np.cumsum(delta_phases)))
+        delta_phases = np.append(delta_phases, 0.0)  # zero delta for last point
 
-        if self.verbose:
-            print('Mean error spline resampling:', np.mean(error_acc))
+        return demo_norm, curve_phases, delta_phases
 
-        # Change axes order to one more intuitive
+    def resample_demos(self, demos_norm, curve_phases, delta_phases):
+        """
+        Resamples normalized demonstrations with linear interpolation along their phases and rolls out the phases to
+        get the positions of the imitation window
+        """
+        n_trajectories = len(demos_norm)
+
+        # Concatenate demos so they can be resampled together; an infinite phase is appended after every demo, so the
+        # last point of a demo interpolates to itself
+        demos_length = np.array([len(phases) for phases in curve_phases])
+        demos_start = np.concatenate(([0], np.cumsum(demos_length[:-1] + 1)))
+        concatenated_length = demos_length.sum() + n_trajectories
+        phases_all = np.full(concatenated_length, np.inf)
+        delta_phases_all = np.zeros(concatenated_length)
+        demos_norm_all = np.empty((self.dim_workspace, concatenated_length))
+        for j in range(n_trajectories):
+            demo_end = demos_start[j] + demos_length[j]
+            phases_all[demos_start[j]:demo_end] = curve_phases[j]
+            delta_phases_all[demos_start[j]:demo_end] = delta_phases[j]
+            demos_norm_all[:, demos_start[j]:demo_end] = demos_norm[j].T
+            demos_norm_all[:, demo_end] = demos_norm[j][-1]
+        max_phases = phases_all[demos_start + demos_length - 1].reshape(-1, 1)
+
+        # Slopes of the linear interpolation in every segment of the curves
+        # For long curves the 1e-15 margin can be lost to rounding, so consecutive phases can be equal and the slope
+        # of that zero-length segment is nan/inf. Those slopes are never used: a segment is only selected if its next
+        # phase is larger than u, which a zero-length segment that starts at or before u can not satisfy
+        phases_diff = np.append(np.diff(phases_all), np.inf)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slopes_delta_phases = np.append(np.diff(delta_phases_all), 0.0) / phases_diff
+            slopes_demos_norm = np.hstack((np.diff(demos_norm_all, axis=1),
+                                           np.zeros((self.dim_workspace, 1)))) / phases_diff
+
+        # Create initial phases u with spatially equidistant points, one row per demonstration
+        u = np.linspace(0, max_phases[:, 0], self.trajectories_resample_length, axis=1)
+
+        # Find the segment of every demo that contains the initial phase values
+        segment = np.stack([np.searchsorted(phases_all[demos_start[j]:demos_start[j] + demos_length[j] + 1], u[j],
+                                            side='right') for j in range(n_trajectories)]) - 1
+        segment += demos_start.reshape(-1, 1)
+
+        # Iterate using imitation window size to get position labels for backpropagation through time
+        window_length = self.imitation_window_size + (self.dynamical_system_order - 1)
+        window = np.empty((window_length, n_trajectories, self.dim_workspace, self.trajectories_resample_length),
+                          dtype=np.float32)  # stored in single precision, which is what the learner uses
+        for i in range(window_length):
+            # Phases only increase, so segments are updated by moving forward until the next phase is larger than u
+            next_segment = phases_all[segment + 1] <= u
+            while next_segment.any():
+                segment += next_segment
+                next_segment = phases_all[segment + 1] <= u
+            phase_progress = u - phases_all[segment]
+
+            # Compute demos positions based on current phase value (linear interpolation along the curves) and
+            # store them in the window trajectories
+            for k in range(self.dim_workspace):
+                window[i, :, k] = slopes_demos_norm[k][segment] * phase_progress + demos_norm_all[k][segment]
+
+            # Find phase for next point in imitation window, not needed after the last one
+            if i < window_length - 1:
+                delta_phase = slopes_delta_phases[segment] * phase_progress + delta_phases_all[segment]
+                u += delta_phase
+                np.minimum(u, max_phases, out=u)  # update phase, phase increments are never negative
+
+        # Change axes order to one more intuitive, contiguous so that sampling training windows is fast
         # 0: trajectories; 1: states trajectory; 2: state dimensions; 3: imitation window position
-        resampled_positions = np.transpose(np.array(resampled_positions), (0, 3, 2, 1))
+        resampled_positions = np.ascontiguousarray(np.transpose(window, (1, 3, 2, 0)))
         return resampled_positions
 
     def get_limits_derivatives(self, demos):
         """
         Computes velocity and acceleration of the training demonstrations
         """
-        # Get velocities from normalized resampled demonstrations
-        velocity = (demos[:, :, :, 1:] - demos[:, :, :, :-1]) / self.delta_t
-
-        # Get accelerations from velocities
-        acceleration = (velocity[:, :, :, 1:] - velocity[:, :, :, :-1]) / self.delta_t
-
-        # Compute max velocities
-        min_velocity = np.min(velocity, axis=(0, 1, 3))
-        max_velocity = np.max(velocity, axis=(0, 1, 3))
-
-        # Compute max acceleration
-        min_acceleration = np.min(acceleration, axis=(0, 1, 3))
-        max_acceleration = np.max(acceleration, axis=(0, 1, 3))
+        # Accelerations need at least three positions in the imitation window
+        if demos.shape[-1] < 3:
+            raise ValueError('Imitation window too short to compute accelerations, '
+                             'imitation_window_size + dynamical_system_order - 1 must be at least 3')
+
+        # Initialize limits, which are updated with every demonstration to avoid storing the velocities and
+        # accelerations of all of the demonstrations at once
+        min_velocity, max_velocity = np.full(self.dim_workspace, np.inf), np.full(self.dim_workspace, -np.inf)
+        min_acceleration, max_acceleration = np.full(self.dim_workspace, np.inf), np.full(self.dim_workspace, -np.inf)
+
+        for demo in demos:  # axes: states trajectory, state dimensions, imitation window position
+            # Get velocities from normalized resampled demonstrations
+            velocity = (demo[:, :, 1:] - demo[:, :, :-1]) / self.delta_t
+
+            # Get accelerations from velocities
+            acceleration = (velocity[:, :, 1:] - velocity[:, :, :-1]) / self.delta_t
+
+            # Update max velocities
+            np.minimum(min_velocity, velocity.min(axis=0).min(axis=-1), out=min_velocity)
+            np.maximum(max_velocity, velocity.max(axis=0).max(axis=-1), out=max_velocity)
+
+            # Update max accelerations
+            np.minimum(min_acceleration, acceleration.min(axis=0).min(axis=-1), out=min_acceleration)
+            np.maximum(max_acceleration, acceleration.max(axis=0).max(axis=-1), out=max_acceleration)
 
         # If second order, since the velocity is part of the state, we extend its limits
         if self.dynamical_system_order == 2:
@@ -1,6 +1,7 @@
 from evaluation.evaluate import Evaluate
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from agent.utils.dynamical_system_operations import denormalize_state
 
 
@@ -33,13 +34,8 @@ class EvaluateND(Evaluate):
         """
         Computes time for plotting simulated trajectories
         """
-        time_history = []
-        time = 0
-
         # Sum every delta to get the time of the trajectory
-        for delta_t in delta_t_history:
-            time = time + delta_t
-            time_history.append(time)
+        time_history = np.cumsum(delta_t_history)
 
         return time_history
 
@@ -50,29 +46,37 @@ class EvaluateND(Evaluate):
         plt.rcdefaults()
         plt.rcParams.update({'font.size': 20})
 
-        # Create subplots
+        # Create subplots; the figure is only saved, so it is created without pyplot to avoid the interactive backend
+        # and to not keep it open after saving
         n_joints = self.dim_workspace
-        fig, axs = plt.subplots(n_joints, figsize=(10, 25))
+        fig = Figure(figsize=(10, 25))
+        axs = fig.subplots(n_joints)
 
         # Add title of subplots
         fig.suptitle('Dynamical System')
 
-        # Plot every joint simulated trajectories
-        denorm_visited_states_grid = denormalize_state(sim_results['visited states grid'], self.x_min, self.x_max)
+        # Subsample simulated trajectories if there are too many of them to be distinguished in the plot
+        max_plotted_trajectories = 500
+        stride = max(1, sim_results['visited states grid'].shape[1] // max_plotted_trajectories)
+
+        # Plot every joint simulated trajectories, with joints in the first axis so every plotted slice is contiguous
+        denorm_visited_states_grid = denormalize_state(sim_results['visited states grid'][:, ::stride], self.x_min, self.x_max)
+        denorm_visited_states_grid = np.ascontiguousarray(denorm_visited_states_grid.transpose(2, 0, 1))
         for i in range(n_joints):
             axs[i].set_title('Joint' + ' ' + str(i + 1))
             axs[i].set_xlabel('time [s]')
             axs[i].set_ylabel('angle [rad]')
             axs[i].grid()
             axs[i].margins(x=0)
-            axs[i].plot(time_simulations, denorm_visited_states_grid[:, :, i], color='blue', linewidth=1.0,
-                        alpha=0.15)
+            axs[i].plot(time_simulations[:, ::stride], denorm_visited_states_grid[i], color='blue', linewidth=1.0,
+                        alpha=0.15, rasterized=True)
 
         # Plot every joint demonstrations
         denorm_visited_states_demos = denormalize_state(sim_results['visited states demos'], self.x_min, self.x_max)
+        denorm_visited_states_demos = np.ascontiguousarray(denorm_visited_states_demos.transpose(2, 0, 1))
         for i in range(n_joints):
             axs[i].plot(time_demonstrations, self.demonstrations_eval[0][i], color='black', linewidth=8)
-            axs[i].plot(time_simulations, denorm_visited_states_demos[:, :, i], color='red', linestyle='--', linewidth=2)
+            axs[i].plot(time_simulations, denorm_visited_states_demos[i], color='red', linestyle='--', linewidth=2)
             axs[i].scatter(time_demonstrations[-1], self.demonstrations_eval[0][i][-1], color='red', edgecolors='black', zorder=10000, s=180)
 
         fig.tight_layout()